@@ -0,0 +1,82 @@
+"""
+Country Names
+Maps the country names the frontend sends onto ISO 3166-1 alpha-2 codes,
+the keys mobility_logic uses
+"""
+import unicodedata
+from typing import Optional
+
+ISO2_BY_NAME = {
+    "afghanistan": "AF", "albania": "AL", "algeria": "DZ", "andorra": "AD", "angola": "AO",
+    "antigua and barbuda": "AG", "argentina": "AR", "armenia": "AM", "australia": "AU",
+    "austria": "AT", "azerbaijan": "AZ", "bahamas": "BS", "bahrain": "BH", "bangladesh": "BD",
+    "barbados": "BB", "belarus": "BY", "belgium": "BE", "belize": "BZ", "benin": "BJ",
+    "bhutan": "BT", "bolivia": "BO", "bosnia and herzegovina": "BA", "botswana": "BW",
+    "brazil": "BR", "brunei": "BN", "bulgaria": "BG", "burkina faso": "BF", "burundi": "BI",
+    "cabo verde": "CV", "cambodia": "KH", "cameroon": "CM", "canada": "CA",
+    "central african republic": "CF", "chad": "TD", "chile": "CL", "china": "CN",
+    "colombia": "CO", "comoros": "KM", "congo": "CG", "democratic republic of the congo": "CD",
+    "costa rica": "CR", "cote d'ivoire": "CI", "croatia": "HR", "cuba": "CU", "cyprus": "CY",
+    "czechia": "CZ", "denmark": "DK", "djibouti": "DJ", "dominica": "DM",
+    "dominican republic": "DO", "ecuador": "EC", "egypt": "EG", "el salvador": "SV",
+    "equatorial guinea": "GQ", "eritrea": "ER", "estonia": "EE", "eswatini": "SZ",
+    "ethiopia": "ET", "fiji": "FJ", "finland": "FI", "france": "FR", "gabon": "GA",
+    "gambia": "GM", "georgia": "GE", "germany": "DE", "ghana": "GH", "greece": "GR",
+    "grenada": "GD", "guatemala": "GT", "guinea": "GN", "guinea-bissau": "GW", "guyana": "GY",
+    "haiti": "HT", "honduras": "HN", "hong kong": "HK", "hungary": "HU", "iceland": "IS",
+    "india": "IN", "indonesia": "ID", "iran": "IR", "iraq": "IQ", "ireland": "IE",
+    "israel": "IL", "italy": "IT", "jamaica": "JM", "japan": "JP", "jordan": "JO",
+    "kazakhstan": "KZ", "kenya": "KE", "kiribati": "KI", "kosovo": "XK", "kuwait": "KW",
+    "kyrgyzstan": "KG", "laos": "LA", "latvia": "LV", "lebanon": "LB", "lesotho": "LS",
+    "liberia": "LR", "libya": "LY", "liechtenstein": "LI", "lithuania": "LT",
+    "luxembourg": "LU", "macao": "MO", "madagascar": "MG", "malawi": "MW", "malaysia": "MY",
+    "maldives": "MV", "mali": "ML", "malta": "MT", "marshall islands": "MH",
+    "mauritania": "MR", "mauritius": "MU", "mexico": "MX", "micronesia": "FM",
+    "moldova": "MD", "monaco": "MC", "mongolia": "MN", "montenegro": "ME", "morocco": "MA",
+    "mozambique": "MZ", "myanmar": "MM", "namibia": "NA", "nauru": "NR", "nepal": "NP",
+    "netherlands": "NL", "new zealand": "NZ", "nicaragua": "NI", "niger": "NE",
+    "nigeria": "NG", "north korea": "KP", "north macedonia": "MK", "norway": "NO",
+    "oman": "OM", "pakistan": "PK", "palau": "PW", "palestine": "PS", "panama": "PA",
+    "papua new guinea": "PG", "paraguay": "PY", "peru": "PE", "philippines": "PH",
+    "poland": "PL", "portugal": "PT", "qatar": "QA", "romania": "RO", "russia": "RU",
+    "rwanda": "RW", "saint kitts and nevis": "KN", "saint lucia": "LC",
+    "saint vincent and the grenadines": "VC", "samoa": "WS", "san marino": "SM",
+    "sao tome and principe": "ST", "saudi arabia": "SA", "senegal": "SN", "serbia": "RS",
+    "seychelles": "SC", "sierra leone": "SL", "singapore": "SG", "slovakia": "SK",
+    "slovenia": "SI", "solomon islands": "SB", "somalia": "SO", "south africa": "ZA",
+    "south korea": "KR", "south sudan": "SS", "spain": "ES", "sri lanka": "LK",
+    "sudan": "SD", "suriname": "SR", "sweden": "SE", "switzerland": "CH", "syria": "SY",
+    "taiwan": "TW", "tajikistan": "TJ", "tanzania": "TZ", "thailand": "TH",
+    "timor-leste": "TL", "togo": "TG", "tonga": "TO", "trinidad and tobago": "TT",
+    "tunisia": "TN", "turkey": "TR", "turkmenistan": "TM", "tuvalu": "TV", "uganda": "UG",
+    "ukraine": "UA", "united arab emirates": "AE", "united kingdom": "GB",
+    "united states": "US", "uruguay": "UY", "uzbekistan": "UZ", "vanuatu": "VU",
+    "vatican city": "VA", "venezuela": "VE", "vietnam": "VN", "yemen": "YE",
+    "zambia": "ZM", "zimbabwe": "ZW",
+    # Common alternative names
+    "usa": "US", "united states of america": "US", "us": "US", "america": "US",
+    "uk": "GB", "great britain": "GB", "britain": "GB", "england": "GB", "scotland": "GB",
+    "wales": "GB", "northern ireland": "GB", "czech republic": "CZ", "ivory coast": "CI",
+    "cape verde": "CV", "swaziland": "SZ", "burma": "MM", "east timor": "TL",
+    "republic of korea": "KR", "korea": "KR", "macedonia": "MK", "holland": "NL",
+    "the netherlands": "NL", "russian federation": "RU", "turkiye": "TR", "uae": "AE",
+    "drc": "CD", "dr congo": "CD", "republic of the congo": "CG", "viet nam": "VN",
+    "holy see": "VA", "vatican": "VA", "the gambia": "GM", "the bahamas": "BS",
+}
+
+ISO2_CODES = set(ISO2_BY_NAME.values())
+
+
+def to_iso2(country: str) -> Optional[str]:
+    """
+    ISO2 code for a country name (or an ISO2 code passed straight through)
+    Returns None if the country isn't recognised
+    """
+    if not country:
+        return None
+    # Fold accents and curly apostrophes: "Côte d’Ivoire" -> "cote d'ivoire"
+    name = unicodedata.normalize("NFKD", country.replace("’", "'")).encode("ascii", "ignore").decode()
+    name = " ".join(name.lower().split())
+    if name.upper() in ISO2_CODES and len(name) == 2:
+        return name.upper()
+    return ISO2_BY_NAME.get(name)
@@ -1,13 +1,31 @@
 import sqlite3
 import os
+from core.profiling import ProfiledConnection
 
 def query_visa_db(origin_code: str, dest_code: str):
-    DB_PATH = os.path.join(os.path.dirname(__file__), '..', 'tara_migration.db')
+    DB_PATH = os.getenv("TARA_DB_PATH", os.path.join(os.path.dirname(__file__), '..', 'tara_migration.db'))
     if not os.path.exists(DB_PATH): return None
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
     cursor = conn.cursor()
     cursor.execute("SELECT rule FROM mobility_logic WHERE origin=? AND dest=?", (origin_code, dest_code))
     result = cursor.fetchone()
     conn.close()
-    return result[0] if result else "unknown"
\ No newline at end of file
+    return result[0] if result else "unknown"
+
+def query_visa_rules(origin_code: str, dest_codes: list) -> dict:
+    """Resolve the rules for several destinations in one query, keyed by dest code"""
+    DB_PATH = os.getenv("TARA_DB_PATH", os.path.join(os.path.dirname(__file__), '..', 'tara_migration.db'))
+    if not os.path.exists(DB_PATH): return {code: None for code in dest_codes}
+    if not dest_codes: return {}
+
+    placeholders = ", ".join("?" for _ in dest_codes)
+    conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
+    cursor = conn.cursor()
+    cursor.execute(
+        f"SELECT dest, rule FROM mobility_logic WHERE origin=? AND dest IN ({placeholders})",
+        (origin_code, *dest_codes)
+    )
+    rules = dict(cursor.fetchall())
+    conn.close()
+    return {code: rules.get(code, "unknown") for code in dest_codes}
@@ -1,24 +1,97 @@
+import json
+from typing import Optional
 from core.database import query_visa_db
 from core.mistral_service import get_expert_advice
+from core.user_profile import get_cached_analysis, save_cached_analysis
 
-def process_request(origin: str, dest: str, user_profile: dict):
+# Profile fields that can change the visa outcome even when the model did not
+# ask for them. Any answer to a field the model did ask for (the cached
+# missing set) always goes back to the model; anything else is kept locally.
+OUTCOME_FIELDS = {
+    "age", "date_of_birth", "income", "citizenship", "citizenship_code",
+    "nationality_code", "current_visas", "existing_visas", "purpose", "reason"
+}
+
+# Stored-profile bookkeeping that says nothing about the trip. These columns
+# appear once the profile exists, so they must not count as newly supplied.
+BOOKKEEPING_FIELDS = {"user_id", "email", "display_name", "created_at", "updated_at"}
+
+# The stored profile and the request name the same fact differently
+FIELD_ALIASES = {"citizenship_code": "nationality_code"}
+
+def _normalize_field(name: str) -> str:
+    return str(name).strip().lower().replace(" ", "_").replace("-", "_")
+
+def _snapshot(profile: dict) -> dict:
+    """
+    The facts the model is judging, keyed the same way whether they came from
+    the request or the stored profile. JSON round-trip so it compares equal
+    to what we stored
+    """
+    facts = {}
+    for key, value in profile.items():
+        if key in BOOKKEEPING_FIELDS:
+            continue
+        key = FIELD_ALIASES.get(key, key)
+        if value or key not in facts:
+            facts[key] = value
+    return json.loads(json.dumps(facts, default=str))
+
+def _changed_fields(previous: dict, current: dict) -> set:
+    """Fields that are newly supplied or have a different value than last time"""
+    return {k for k, v in current.items() if v and previous.get(k) != v}
+
+def _needs_model(changed: set, missing_fields: list) -> bool:
+    """True if a newly supplied field answers one of the model's gaps or can change the outcome"""
+    relevant = OUTCOME_FIELDS | {_normalize_field(f) for f in missing_fields}
+    return any(_normalize_field(f) in relevant for f in changed)
+
+def process_request(origin: str, dest: str, user_profile: dict, user_id: Optional[str] = None,
+                    db_status: Optional[str] = None):
     # 1. Anonymize
     safe_profile = {k: v for k, v in user_profile.items() if k != "name"}
 
-    # 2. Database Check
-    db_status = query_visa_db(origin[:2].upper(), dest[:2].upper())
-    
+    # 2. Database Check (callers that batch the lookup pass db_status in)
+    if db_status is None:
+        db_status = query_visa_db(origin[:2].upper(), dest[:2].upper())
+
     # 3. AI Analysis
-    ai_details = get_expert_advice(origin, dest, safe_profile)
-    
+    # On a recent resubmission for the same corridor, only go back to the
+    # model if a newly supplied field answers one of its gaps or can change
+    # the outcome.
+    snapshot = _snapshot(safe_profile)
+    cached = get_cached_analysis(user_id, origin, dest) if user_id else None
+    ai_details = None
+    from_model = False
+    data_source = "Hybrid (DB + Mistral AI)"
+
+    if cached:
+        changed = _changed_fields(cached["profile"], snapshot)
+        if not _needs_model(changed, cached["missing_fields"]):
+            ai_details = cached["analysis"]
+            data_source = "Hybrid (DB + cached Mistral AI)"
+
+    if ai_details is None:
+        ai_details = get_expert_advice(origin, dest, safe_profile, rule=db_status)
+        if ai_details.get("advice_source") == "local":
+            data_source = "Hybrid (DB + local rules)"
+        else:
+            from_model = "error_log" not in ai_details
+
+    # Only a fresh model answer is cached. Re-saving a cache hit would push
+    # updated_at forward and the entry would never expire; the offline
+    # fallback and local-tier answers aren't cached so the next call retries
+    if user_id and from_model:
+        save_cached_analysis(user_id, origin, dest, ai_details, snapshot)
+
     # --- NEW LOGIC: Determine Status ---
     # If the AI identified missing fields, status is "INCOMPLETE"
     has_gaps = len(ai_details.get("awaiting_feedback", {})) > 0
     status = "INCOMPLETE" if has_gaps else "SUCCESS"
-    
+
     return {
         "status": status,
         "summary": db_status,
         "expert_analysis": ai_details,
-        "data_source": "Hybrid (DB + Mistral AI)"
-    }
\ No newline at end of file
+        "data_source": data_source
+    }
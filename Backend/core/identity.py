@@ -0,0 +1,158 @@
+"""
+Identity Resolution
+Maps user ids and emails onto one canonical user_profiles key, so the same
+person never ends up with two profiles (one under their id, one under their email)
+"""
+import sqlite3
+import os
+from typing import Optional, Dict, Tuple
+from datetime import datetime
+from core.profiling import ProfiledConnection
+from core.user_profile import PROFILE_FIELDS, normalize_email, get_user_profile
+
+DB_PATH = os.getenv("TARA_DB_PATH", os.path.join(os.path.dirname(__file__), '..', 'tara_migration.db'))
+
+# alias -> canonical user_id. Aliases are only re-pointed when two profiles
+# are merged, which evicts the stale entries in this process; other workers
+# notice when the cached profile is gone (see resolve_profile). The size cap
+# only bounds memory.
+MAX_CACHED_ALIASES = 50000
+_alias_cache: Dict[str, str] = {}
+
+
+def _remember(aliases: Dict[str, str]):
+    if len(_alias_cache) + len(aliases) > MAX_CACHED_ALIASES:
+        _alias_cache.clear()
+    _alias_cache.update(aliases)
+
+
+def _forget(canonical: str):
+    """Drop every cached alias pointing at a profile that no longer exists"""
+    for alias in [alias for alias, user_id in _alias_cache.items() if user_id == canonical]:
+        del _alias_cache[alias]
+
+
+def _merge_profiles(cursor, survivor: str, duplicate: str):
+    """
+    Fold the duplicate profile into the survivor (the survivor's values win,
+    the duplicate fills the gaps) and re-point everything keyed by it
+    """
+    columns = ', '.join(PROFILE_FIELDS)
+    cursor.execute(f"SELECT {columns}, created_at FROM user_profiles WHERE user_id = ?", (duplicate,))
+    row = cursor.fetchone()
+    if row:
+        # Delete first so the duplicate's email can move without hitting UNIQUE(email)
+        cursor.execute("DELETE FROM user_profiles WHERE user_id = ?", (duplicate,))
+        cursor.execute(f"""
+            INSERT INTO user_profiles (user_id, {columns}, created_at, updated_at)
+            VALUES (?, {', '.join('?' for _ in PROFILE_FIELDS)}, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                {', '.join(f'{field} = COALESCE(user_profiles.{field}, excluded.{field})' for field in PROFILE_FIELDS)},
+                created_at = MIN(user_profiles.created_at, excluded.created_at),
+                updated_at = excluded.updated_at
+        """, (survivor, *row, datetime.utcnow().isoformat()))
+    cursor.execute("UPDATE conversation_history SET user_id = ? WHERE user_id = ?", (survivor, duplicate))
+    # Cached analyses were built from the duplicate's partial profile
+    cursor.execute("DELETE FROM analysis_cache WHERE user_id = ?", (duplicate,))
+    cursor.execute("UPDATE identity_aliases SET user_id = ? WHERE user_id = ?", (survivor, duplicate))
+    cursor.execute("INSERT OR REPLACE INTO identity_aliases (alias, user_id) VALUES (?, ?)", (duplicate, survivor))
+    print(f"🔗 Merged profile {duplicate} into {survivor}")
+
+
+def _known_keys(cursor, user_id: Optional[str], email: Optional[str]):
+    """
+    Canonical key for each of user_id/email that is already known: from the
+    alias table, or else from user_profiles itself, for profiles written
+    without going through here (bulk imports, /profile/update)
+    Returns (known, keys that still need an alias row)
+    """
+    keys = [key for key in (user_id, email) if key]
+    cursor.execute(
+        f"SELECT alias, user_id FROM identity_aliases WHERE alias IN ({', '.join('?' for _ in keys)})",
+        keys
+    )
+    known = dict(cursor.fetchall())
+    unaliased = [key for key in keys if key not in known]
+
+    if user_id and user_id not in known:
+        cursor.execute("SELECT 1 FROM user_profiles WHERE user_id = ?", (user_id,))
+        if cursor.fetchone():
+            known[user_id] = user_id
+    if email and email not in known:
+        cursor.execute("SELECT user_id FROM user_profiles WHERE email = ?", (email,))
+        row = cursor.fetchone()
+        if row:
+            known[email] = row[0]
+    return known, unaliased
+
+
+def resolve_identity(user_id: Optional[str] = None, email: Optional[str] = None,
+                     register: bool = True, cached: bool = True) -> Optional[str]:
+    """
+    Return the canonical profile key for this user id and/or email
+    An explicit user id wins over an email. Unknown keys are registered as
+    aliases of the result (unless register=False), so the next lookup is a
+    cache hit (cached=False skips the cache). If the id and the email belong
+    to two different profiles, the email's profile is merged into the id's.
+    Returns None if neither is given
+    """
+    email = normalize_email(email)
+    keys = [key for key in (user_id, email) if key]
+    if not keys:
+        return None
+
+    # Fast path: every key already known and pointing at the same profile
+    if cached and all(key in _alias_cache for key in keys) and len({_alias_cache[key] for key in keys}) == 1:
+        return _alias_cache[keys[0]]
+
+    conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
+    try:
+        cursor = conn.cursor()
+        known, unaliased = _known_keys(cursor, user_id, email)
+        canonical = next((known[key] for key in keys if key in known), keys[0])
+
+        if register and len(set(known.values())) > 1:
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                # Re-read under the write lock, a concurrent request may have merged already
+                known, unaliased = _known_keys(cursor, user_id, email)
+                canonical = next(known[key] for key in keys if key in known)
+                for duplicate in set(known.values()) - {canonical}:
+                    _merge_profiles(cursor, canonical, duplicate)
+                    _forget(duplicate)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            known = {key: canonical for key in known}
+
+        if register and unaliased:
+            cursor.executemany(
+                "INSERT OR IGNORE INTO identity_aliases (alias, user_id) VALUES (?, ?)",
+                [(key, known.get(key, canonical)) for key in unaliased]
+            )
+            conn.commit()
+            # Another request may have registered one of these first, its mapping wins
+            known, _ = _known_keys(cursor, user_id, email)
+            canonical = next(known[key] for key in keys if key in known)
+    finally:
+        conn.close()
+
+    _remember(known)
+    return canonical
+
+
+def resolve_profile(user_id: Optional[str] = None, email: Optional[str] = None,
+                    register: bool = True) -> Tuple[Optional[str], Optional[dict]]:
+    """
+    resolve_identity plus the stored profile (None for a new user)
+    The alias cache is per process, so it can point at a profile another
+    worker has merged away; if the profile is missing, resolve again from
+    the database
+    """
+    canonical = resolve_identity(user_id, email, register)
+    profile = get_user_profile(canonical) if canonical else None
+    if canonical and profile is None:
+        canonical = resolve_identity(user_id, email, register, cached=False)
+        profile = get_user_profile(canonical)
+    return canonical, profile
@@ -0,0 +1,258 @@
+"""
+Schema Migrations
+Versioned migrations for tara_migration.db, tracked in PRAGMA user_version.
+Each migration runs in its own transaction; the database is switched to WAL
+so readers keep working while a migration holds the write lock.
+"""
+import sqlite3
+import os
+from core.profiling import ProfiledConnection
+
+DB_PATH = os.getenv("TARA_DB_PATH", os.path.join(os.path.dirname(__file__), '..', 'tara_migration.db'))
+
+# STRICT tables need SQLite 3.37+, older builds get the same schema without it
+STRICT = ", STRICT" if sqlite3.sqlite_version_info >= (3, 37, 0) else ""
+
+
+def _baseline(cursor):
+    """Tables as they were created before migrations existed"""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS user_profiles (
+            user_id TEXT PRIMARY KEY,
+            email TEXT UNIQUE,
+            display_name TEXT,
+            citizenship TEXT,
+            citizenship_code TEXT,
+            date_of_birth TEXT,
+            passport_number TEXT,
+            existing_visas TEXT,  -- JSON string of existing visas
+            created_at TEXT,
+            updated_at TEXT
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS conversation_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            request_type TEXT,
+            origin TEXT,
+            destination TEXT,
+            purpose TEXT,
+            status TEXT,
+            ai_response TEXT,  -- JSON string of the AI response
+            created_at TEXT,
+            FOREIGN KEY (user_id) REFERENCES user_profiles(user_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS analysis_cache (
+            user_id TEXT,
+            origin TEXT,
+            destination TEXT,
+            analysis TEXT,          -- JSON string of the last AI analysis
+            missing_fields TEXT,    -- JSON list of fields the AI was still waiting on
+            profile_snapshot TEXT,  -- JSON string of the profile the analysis was built from
+            updated_at TEXT,
+            PRIMARY KEY (user_id, origin, destination)
+        )
+    """)
+    # Normally created by scripts/sync_database.py
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS mobility_logic (
+            origin TEXT,
+            dest TEXT,
+            rule TEXT
+        )
+    """)
+
+
+def _rebuild(cursor, table: str, create_sql: str, copy_sql: str):
+    """Copy a table into a new definition and swap it in place"""
+    cursor.execute(f"DROP TABLE IF EXISTS {table}_new")
+    cursor.execute(create_sql.format(table=f"{table}_new"))
+    cursor.execute(copy_sql.format(table=f"{table}_new"))
+    cursor.execute(f"DROP TABLE {table}")
+    cursor.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+
+
+def _strict_tables(cursor):
+    """Rebuild every table as STRICT with proper keys"""
+    # (origin, dest) is the only lookup on this table, so making it the
+    # clustered key turns the rule query into a single covering b-tree seek.
+    # pandas read Namibia's "NA" code as a missing value, put it back.
+    _rebuild(cursor, "mobility_logic", f"""
+        CREATE TABLE {{table}} (
+            origin TEXT NOT NULL,
+            dest TEXT NOT NULL,
+            rule TEXT,
+            PRIMARY KEY (origin, dest)
+        ) WITHOUT ROWID{STRICT}
+    """, """
+        INSERT OR REPLACE INTO {table} (origin, dest, rule)
+        SELECT COALESCE(origin, 'NA'), COALESCE(dest, 'NA'), rule FROM mobility_logic
+    """)
+
+    _rebuild(cursor, "user_profiles", f"""
+        CREATE TABLE {{table}} (
+            user_id TEXT PRIMARY KEY,
+            email TEXT UNIQUE,
+            display_name TEXT,
+            citizenship TEXT,
+            citizenship_code TEXT,
+            date_of_birth TEXT,
+            passport_number TEXT,
+            existing_visas TEXT,  -- JSON string of existing visas
+            created_at TEXT,
+            updated_at TEXT
+        ){STRICT}
+    """, """
+        INSERT INTO {table} SELECT * FROM user_profiles
+    """)
+
+    _rebuild(cursor, "conversation_history", f"""
+        CREATE TABLE {{table}} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id TEXT,
+            request_type TEXT,
+            origin TEXT,
+            destination TEXT,
+            purpose TEXT,
+            status TEXT,
+            ai_response TEXT,  -- JSON string of the AI response
+            created_at TEXT,
+            FOREIGN KEY (user_id) REFERENCES user_profiles(user_id)
+        ){STRICT}
+    """, """
+        INSERT INTO {table} SELECT * FROM conversation_history
+    """)
+
+    _rebuild(cursor, "analysis_cache", f"""
+        CREATE TABLE {{table}} (
+            user_id TEXT NOT NULL,
+            origin TEXT NOT NULL,
+            destination TEXT NOT NULL,
+            analysis TEXT,          -- JSON string of the last AI analysis
+            missing_fields TEXT,    -- JSON list of fields the AI was still waiting on
+            profile_snapshot TEXT,  -- JSON string of the profile the analysis was built from
+            updated_at TEXT,
+            PRIMARY KEY (user_id, origin, destination)
+        ) WITHOUT ROWID{STRICT}
+    """, """
+        INSERT INTO {table} SELECT * FROM analysis_cache
+    """)
+
+
+def _identity_aliases(cursor):
+    """Alias table mapping user ids and emails onto one canonical profile key"""
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS identity_aliases (
+            alias TEXT PRIMARY KEY,   -- a user_id or a lower-cased email
+            user_id TEXT NOT NULL     -- canonical user_profiles.user_id
+        ) WITHOUT ROWID{STRICT}
+    """)
+    # Emails first, from profiles keyed by a real id rather than by the email
+    # itself, so an email-keyed duplicate resolves to the id-keyed profile
+    cursor.execute("""
+        INSERT OR IGNORE INTO identity_aliases (alias, user_id)
+        SELECT lower(trim(email)), user_id FROM user_profiles
+        WHERE email IS NOT NULL AND trim(email) != ''
+        ORDER BY lower(trim(email)) = lower(user_id), created_at
+    """)
+    cursor.execute("""
+        INSERT OR IGNORE INTO identity_aliases (alias, user_id)
+        SELECT user_id, user_id FROM user_profiles
+    """)
+    # Fold what the duplicates knew (e.g. a citizenship stored under the
+    # email key) into the canonical profile
+    cursor.execute("""
+        UPDATE user_profiles AS p SET
+            citizenship = COALESCE(p.citizenship, d.citizenship),
+            citizenship_code = COALESCE(p.citizenship_code, d.citizenship_code),
+            date_of_birth = COALESCE(p.date_of_birth, d.date_of_birth),
+            passport_number = COALESCE(p.passport_number, d.passport_number),
+            existing_visas = COALESCE(p.existing_visas, d.existing_visas)
+        FROM identity_aliases AS a
+        JOIN user_profiles AS d ON d.user_id = a.alias
+        WHERE a.user_id = p.user_id AND a.alias != p.user_id
+    """)
+
+
+# (version, description, list of SQL statements or a function taking a cursor)
+MIGRATIONS = [
+    (1, "Baseline tables", _baseline),
+    (2, "STRICT tables with primary keys", _strict_tables),
+    (3, "Indexes for hot queries", [
+        # get_user_conversation_history: WHERE user_id = ? ORDER BY created_at DESC
+        "CREATE INDEX IF NOT EXISTS idx_conversation_history_user_created "
+        "ON conversation_history (user_id, created_at)",
+        # user_profiles(email) is already served by its UNIQUE autoindex
+    ]),
+    (4, "Planner statistics", ["ANALYZE"]),
+    (5, "Identity aliases", _identity_aliases),
+    (6, "Corridor counters for archived history", [
+        # Filled by scripts/archive_history.py as old rows leave conversation_history
+        f"""
+        CREATE TABLE IF NOT EXISTS corridor_stats (
+            origin TEXT NOT NULL DEFAULT '',
+            destination TEXT NOT NULL DEFAULT '',
+            purpose TEXT NOT NULL DEFAULT '',
+            status TEXT NOT NULL DEFAULT '',
+            requests INTEGER NOT NULL DEFAULT 0,
+            first_seen TEXT,
+            last_seen TEXT,
+            PRIMARY KEY (origin, destination, purpose, status)
+        ) WITHOUT ROWID{STRICT}
+        """,
+        # The retention job walks history oldest first
+        "CREATE INDEX IF NOT EXISTS idx_conversation_history_created "
+        "ON conversation_history (created_at)",
+    ]),
+]
+
+
+def run_migrations(db_path: str = DB_PATH) -> int:
+    """
+    Apply every migration newer than the database's user_version
+    Returns the schema version the database ends up at
+    """
+    # Autocommit mode so each migration controls its own transaction
+    conn = sqlite3.connect(db_path, isolation_level=None, factory=ProfiledConnection)
+    conn.execute("PRAGMA busy_timeout = 5000")
+    conn.execute("PRAGMA journal_mode = WAL")
+
+    current = conn.execute("PRAGMA user_version").fetchone()[0]
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+
+        cursor = conn.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        # Another worker may have applied it while we waited for the lock
+        current = cursor.execute("PRAGMA user_version").fetchone()[0]
+        if version <= current:
+            cursor.execute("COMMIT")
+            continue
+        try:
+            if callable(step):
+                step(cursor)
+            else:
+                for statement in step:
+                    cursor.execute(statement)
+            cursor.execute(f"PRAGMA user_version = {version}")
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            conn.close()
+            raise
+
+        current = version
+        print(f"✅ Applied migration {version}: {description}")
+
+    # Cheap on every start: only re-analyzes tables whose stats went stale
+    conn.execute("PRAGMA optimize")
+    conn.close()
+    return current
+
+
+if __name__ == "__main__":
+    print(f"📦 Schema version: {run_migrations()}")
@@ -1,64 +1,251 @@
 import os, json
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Optional
 from mistralai import Mistral
 from dotenv import load_dotenv
+from core.database import query_visa_db
 
 load_dotenv()
 client = Mistral(api_key=os.getenv("MISTRAL_API_KEY"))
 
-def get_expert_advice(origin: str, destination: str, specifics: dict):
-    # 1. Build a context string ONLY for provided info
-    context = "\n".join([f"- {k}: {v}" for k, v in specifics.items() if v])
-    
-    # 2. Refined Prompt for "Awaiting Feedback" logic
-    prompt = f"""
-    Act as an International Migration & Security Expert. 
-    Analyze travel from {origin} to {destination}.
-    
-    USER PROFILE PROVIDED:
-    {context if context else "None provided."}
-    
-    YOUR MISSION:
-    If the provided profile is missing critical data (Age, Income, Citizenship, or Current Visas) 
-    that would change the visa outcome, identify them.
-    
-    MANDATORY OUTPUT (JSON ONLY):
-    {{
-      "forms": ["list of required digital forms/ETIAS"],
-      "health": ["mandatory vaccinations and insurance"],
-      "safety": ["official travel notices"],
-      "awaiting_feedback": {{
-          "field_name": "Friendly explanation of why this specific info is needed"
-      }}
-    }}
-    
-    STRICT: No PII (names/IDs). No guessing.
+# "remote" = Mistral only, "local" = rules engine only,
+# "hedged" = Mistral, but answer locally if it fails or misses the SLO.
+# Hedged is opt-in until the SLO is tuned: a call that already started when
+# the SLO expires is still billed, its answer is dropped and the local answer
+# isn't cached, so a slow-but-working model would be paid for on every request.
+ADVICE_MODE = os.getenv("TARA_ADVICE_MODE", "remote")
+ADVICE_SLO_SECONDS = float(os.getenv("TARA_ADVICE_SLO_SECONDS", "8"))
+
+# Mistral calls in flight at once per request (used by /tourism/compare)
+MAX_CONCURRENT_AI_CALLS = 5
+
+# Hedged-mode remote calls run here. Room for several requests fanning out at
+# MAX_CONCURRENT_AI_CALLS, plus calls that missed the SLO after starting
+# (those can't be cancelled and finish in the background, result dropped).
+REMOTE_POOL_SIZE = int(os.getenv("TARA_REMOTE_POOL_SIZE", str(MAX_CONCURRENT_AI_CALLS * 4)))
+_remote_pool = ThreadPoolExecutor(max_workers=REMOTE_POOL_SIZE, thread_name_prefix="mistral")
+
+
+class AdviceProvider(ABC):
+    """
+    Interface for anything that can produce expert advice for a corridor
+    get_advice must return the forms/health/safety/awaiting_feedback dict
     """
+    name = "base"
 
-    try:
-        # 3. The actual API Call
-        res = client.chat.complete(
-            model="mistral-large-latest",
-            messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"}
-        )
-        
-        # Parse the JSON string into a Python Dictionary
-        ai_data = json.loads(res.choices[0].message.content)
-        
-        # 4. Fallback: Ensure 'awaiting_feedback' exists in the dictionary 
-        # so engine.py doesn't crash
-        if "awaiting_feedback" not in ai_data:
-            ai_data["awaiting_feedback"] = {}
-            
-        return ai_data
+    @abstractmethod
+    def get_advice(self, origin: str, destination: str, specifics: dict, rule: Optional[str] = None) -> dict:
+        ...
+
+
+class MistralAdviceProvider(AdviceProvider):
+    """Remote tier: asks Mistral for a full analysis"""
+    name = "mistral"
+
+    def get_advice(self, origin: str, destination: str, specifics: dict, rule: Optional[str] = None) -> dict:
+        # 1. Build a context string ONLY for provided info
+        context = "\n".join([f"- {k}: {v}" for k, v in specifics.items() if v])
+
+        # 2. Refined Prompt for "Awaiting Feedback" logic
+        prompt = f"""
+        Act as an International Migration & Security Expert.
+        Analyze travel from {origin} to {destination}.
+
+        USER PROFILE PROVIDED:
+        {context if context else "None provided."}
+
+        YOUR MISSION:
+        If the provided profile is missing critical data (Age, Income, Citizenship, or Current Visas)
+        that would change the visa outcome, identify them.
+
+        MANDATORY OUTPUT (JSON ONLY):
+        {{
+          "forms": ["list of required digital forms/ETIAS"],
+          "health": ["mandatory vaccinations and insurance"],
+          "safety": ["official travel notices"],
+          "awaiting_feedback": {{
+              "field_name": "Friendly explanation of why this specific info is needed"
+          }}
+        }}
+
+        STRICT: No PII (names/IDs). No guessing.
+        """
+
+        try:
+            # 3. The actual API Call
+            res = client.chat.complete(
+                model="mistral-large-latest",
+                messages=[{"role": "user", "content": prompt}],
+                response_format={"type": "json_object"}
+            )
+
+            # Parse the JSON string into a Python Dictionary
+            ai_data = json.loads(res.choices[0].message.content)
+
+            # 4. Fallback: Ensure 'awaiting_feedback' exists in the dictionary
+            # so engine.py doesn't crash
+            if "awaiting_feedback" not in ai_data:
+                ai_data["awaiting_feedback"] = {}
+
+            ai_data["advice_source"] = self.name
+            return ai_data
+
+        except Exception as e:
+            print(f"❌ Mistral API Error: {e}")
+            # Return a structured fallback so the engine can still process the response
+            return {
+                "forms": [],
+                "health": [],
+                "safety": [],
+                "awaiting_feedback": {"error": "Expert service temporarily offline"},
+                "error_log": str(e)
+            }
+
+
+# --- Local tier data ---
+SCHENGEN = {
+    "AT", "BE", "BG", "HR", "CZ", "DK", "EE", "FI", "FR", "DE", "GR", "HU", "IS", "IT",
+    "LV", "LI", "LT", "LU", "MT", "NL", "NO", "PL", "PT", "RO", "SK", "SI", "ES", "SE", "CH"
+}
+
+# EU member states (Ireland and Cyprus are EU but not Schengen)
+EU = {
+    "AT", "BE", "BG", "HR", "CY", "CZ", "DK", "EE", "FI", "FR", "DE", "GR", "HU", "IE",
+    "IT", "LV", "LT", "LU", "MT", "NL", "PL", "PT", "RO", "SK", "SI", "ES", "SE"
+}
+
+# Electronic travel authorisations needed by visa-exempt travellers
+TRAVEL_AUTHORISATIONS = {
+    "US": "ESTA (Electronic System for Travel Authorization)",
+    "CA": "eTA (Electronic Travel Authorization)",
+    "GB": "UK ETA (Electronic Travel Authorisation)",
+    "AU": "ETA or eVisitor (subclass 601/651)",
+    "NZ": "NZeTA (New Zealand Electronic Travel Authority)",
+    "KR": "K-ETA (Korea Electronic Travel Authorization)",
+    **{code: "ETIAS travel authorisation (once in force)" for code in SCHENGEN}
+}
+
+# Nationalities that don't need the destination's travel authorisation
+TRAVEL_AUTHORISATION_EXEMPT = {
+    "US": {"CA"},          # Canadians need no ESTA
+    "CA": {"US"},          # US citizens need no eTA
+    "GB": {"IE"},          # Common Travel Area
+    "AU": {"NZ"},          # New Zealanders get a visa on arrival, no ETA
+    "NZ": {"AU"},          # Australians need no NZeTA
+    **{code: EU | SCHENGEN for code in SCHENGEN}  # No ETIAS for EU/Schengen citizens
+}
+
+# Destinations that require a yellow fever certificate from all arriving travellers
+YELLOW_FEVER_REQUIRED = {"AO", "BI", "CF", "CG", "CD", "CI", "GA", "GH", "GW", "ML", "NE", "TG", "GF"}
+
+# What each mobility_logic rule category means for the traveller's paperwork
+RULE_FORMS = {
+    "visa free": [],
+    "eta": ["Electronic travel authorisation (apply online before departure)"],
+    "visa on arrival": ["Visa on arrival application (completed at the port of entry)"],
+    "e-visa": ["e-Visa application (official online portal)"],
+    "visa required": ["Visa application form (embassy or consulate)"],
+    "no admission": [],
+    "unknown": ["Confirm entry requirements with the destination embassy"]
+}
+
+
+def rule_category(rule: Optional[str]) -> str:
+    """Map a raw mobility_logic rule onto one of the RULE_FORMS categories"""
+    if not rule:
+        return "unknown"
+    rule = rule.lower()
+    # Numeric rules are visa-free stays in days (-1 means the traveller's own country)
+    if rule.lstrip("-").isdigit():
+        return "visa free"
+    return rule if rule in RULE_FORMS else "unknown"
+
+
+class LocalAdviceProvider(AdviceProvider):
+    """
+    Local tier: deterministic rules over the mobility_logic categories
+    and the curated per-country tables above. No network, no model
+    """
+    name = "local"
+
+    def get_advice(self, origin: str, destination: str, specifics: dict, rule: Optional[str] = None) -> dict:
+        origin_code, dest_code = origin[:2].upper(), destination[:2].upper()
+        if rule is None:
+            rule = query_visa_db(origin_code, dest_code)
+        category = rule_category(rule)
+
+        # -1 is the traveller's own country: nothing to apply for
+        if rule == "-1" or origin_code == dest_code:
+            forms = []
+        else:
+            forms = list(RULE_FORMS[category])
+            if (category in ("visa free", "eta") and dest_code in TRAVEL_AUTHORISATIONS
+                    and origin_code not in TRAVEL_AUTHORISATION_EXEMPT.get(dest_code, set())):
+                forms = [TRAVEL_AUTHORISATIONS[dest_code]]
+            if category == "visa free" and rule and rule.isdigit():
+                forms.append(f"Stay limit: {rule} days without a visa")
+
+        health = ["Travel insurance covering medical treatment and repatriation"]
+        if dest_code in YELLOW_FEVER_REQUIRED:
+            health.insert(0, "Yellow fever vaccination certificate")
+        if dest_code in SCHENGEN and category != "visa free":
+            health.append("Schengen visa insurance with at least EUR 30,000 medical cover")
+
+        safety = [f"Check your government's official travel advisory for {destination}"]
+        if category == "no admission":
+            safety.insert(0, f"Entry to {destination} is currently not permitted on a {origin} passport")
+
+        # Only ask for what can change a 'visa required' outcome
+        awaiting_feedback = {}
+        if category == "visa required" and not (specifics.get("existing_visas") or specifics.get("current_visas")):
+            awaiting_feedback["existing_visas"] = (
+                "Some destinations waive or simplify the visa for holders of certain "
+                "visas (e.g. US, UK or Schengen). Tell us which visas you already hold."
+            )
 
-    except Exception as e:
-        print(f"❌ Mistral API Error: {e}")
-        # Return a structured fallback so the engine can still process the response
         return {
-            "forms": [],
-            "health": [],
-            "safety": [],
-            "awaiting_feedback": {"error": "Expert service temporarily offline"},
-            "error_log": str(e)
-        }
\ No newline at end of file
+            "forms": forms,
+            "health": health,
+            "safety": safety,
+            "awaiting_feedback": awaiting_feedback,
+            "advice_source": self.name
+        }
+
+
+remote_provider: AdviceProvider = MistralAdviceProvider()
+local_provider: AdviceProvider = LocalAdviceProvider()
+
+def set_advice_providers(remote: Optional[AdviceProvider] = None, local: Optional[AdviceProvider] = None):
+    """Swap out either tier, e.g. for a different model vendor or a richer knowledge base"""
+    global remote_provider, local_provider
+    if remote is not None:
+        remote_provider = remote
+    if local is not None:
+        local_provider = local
+
+
+def get_expert_advice(origin: str, destination: str, specifics: dict, rule: Optional[str] = None):
+    if ADVICE_MODE == "local":
+        return local_provider.get_advice(origin, destination, specifics, rule)
+    if ADVICE_MODE == "remote":
+        return remote_provider.get_advice(origin, destination, specifics, rule)
+
+    # Hedged: give the remote tier until the SLO, then answer locally
+    future = _remote_pool.submit(remote_provider.get_advice, origin, destination, specifics, rule)
+    try:
+        ai_data = future.result(timeout=ADVICE_SLO_SECONDS)
+    except FutureTimeout:
+        # A call still waiting for a worker never reaches the (paid) remote API
+        cancelled = future.cancel()
+        print(f"⏱️ {remote_provider.name} missed the {ADVICE_SLO_SECONDS}s SLO - answering locally"
+              f"{' (cancelled before it started)' if cancelled else ''}")
+        return local_provider.get_advice(origin, destination, specifics, rule)
+    except Exception as e:
+        print(f"❌ {remote_provider.name} provider error: {e}")
+        return local_provider.get_advice(origin, destination, specifics, rule)
+
+    if "error_log" in ai_data:
+        print(f"🔁 {remote_provider.name} unavailable - answering locally")
+        return local_provider.get_advice(origin, destination, specifics, rule)
+    return ai_data
@@ -4,51 +4,43 @@ Handles storing and retrieving user data to avoid repeat questions
 """
 import sqlite3
 import os
-from typing import Optional, Dict, Any
-from datetime import datetime
+import json
+from typing import Optional, Dict, Any, List
+from datetime import datetime, timedelta
+from core.profiling import ProfiledConnection
+from core.migrations import run_migrations
 
-DB_PATH = os.path.join(os.path.dirname(__file__), '..', 'tara_migration.db')
+# TARA_DB_PATH points the app (and the tests) at another database file
+DB_PATH = os.getenv("TARA_DB_PATH", os.path.join(os.path.dirname(__file__), '..', 'tara_migration.db'))
+
+# The analysis cache only serves follow-up resubmissions, not later visits
+ANALYSIS_CACHE_TTL_MINUTES = int(os.getenv("TARA_ANALYSIS_CACHE_TTL_MINUTES", "30"))
+
+# Columns a caller is allowed to write on user_profiles
+PROFILE_FIELDS = ['email', 'display_name', 'citizenship', 'citizenship_code',
+                  'date_of_birth', 'passport_number', 'existing_visas']
+
+# Single-statement insert-or-merge. COALESCE keeps the stored value for any
+# field the caller did not pass, so partial updates never null out columns.
+UPSERT_PROFILE_SQL = f"""
+    INSERT INTO user_profiles
+    (user_id, {', '.join(PROFILE_FIELDS)}, created_at, updated_at)
+    VALUES (?, {', '.join('?' for _ in PROFILE_FIELDS)}, ?, ?)
+    ON CONFLICT(user_id) DO UPDATE SET
+        {', '.join(f'{field} = COALESCE(excluded.{field}, user_profiles.{field})' for field in PROFILE_FIELDS)},
+        updated_at = excluded.updated_at
+"""
+
+def normalize_email(email: Optional[str]) -> Optional[str]:
+    """Emails are stored and looked up trimmed and lower-cased; blank means no email"""
+    return email.strip().lower() if email and email.strip() else None
 
 def init_user_profiles_table():
     """
-    Create the user_profiles table if it doesn't exist
+    Bring the database schema up to date (see core/migrations.py)
     Call this when the app starts
     """
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS user_profiles (
-            user_id TEXT PRIMARY KEY,
-            email TEXT UNIQUE,
-            display_name TEXT,
-            citizenship TEXT,
-            citizenship_code TEXT,
-            date_of_birth TEXT,
-            passport_number TEXT,
-            existing_visas TEXT,  -- JSON string of existing visas
-            created_at TEXT,
-            updated_at TEXT
-        )
-    """)
-    
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS conversation_history (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT,
-            request_type TEXT,
-            origin TEXT,
-            destination TEXT,
-            purpose TEXT,
-            status TEXT,
-            ai_response TEXT,  -- JSON string of the AI response
-            created_at TEXT,
-            FOREIGN KEY (user_id) REFERENCES user_profiles(user_id)
-        )
-    """)
-    
-    conn.commit()
-    conn.close()
+    run_migrations(DB_PATH)
     print("✅ Database tables initialized")
 
 def get_user_profile(user_id: str) -> Optional[Dict[str, Any]]:
@@ -59,7 +51,7 @@ def get_user_profile(user_id: str) -> Optional[Dict[str, Any]]:
     if not user_id:
         return None
         
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -88,70 +80,80 @@ def get_user_profile(user_id: str) -> Optional[Dict[str, Any]]:
         "updated_at": result[9]
     }
 
-def save_user_profile(user_id: str, profile_data: Dict[str, Any]) -> bool:
+def _upsert_params(user_id: str, profile_data: Dict[str, Any], now: str) -> tuple:
     """
-    Save or update a user's profile
+    Build the parameter tuple for UPSERT_PROFILE_SQL
+    Fields missing from profile_data are passed as NULL so COALESCE keeps the stored value
+    """
+    profile_data = {**profile_data, 'email': normalize_email(profile_data.get('email'))}
+    return (
+        user_id,
+        *[profile_data.get(field) for field in PROFILE_FIELDS],
+        now,
+        now
+    )
+
+def upsert_profile(user_id: str, partial_fields: Dict[str, Any]) -> bool:
+    """
+    Insert or partially update a user's profile in a single statement
+    Only the fields passed in partial_fields are written, everything else is kept
     Returns True if successful
     """
     if not user_id:
         return False
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
+    try:
+        cursor = conn.cursor()
     
-    now = datetime.utcnow().isoformat()
+        now = datetime.utcnow().isoformat()
+        cursor.execute(UPSERT_PROFILE_SQL, _upsert_params(user_id, partial_fields, now))
     
-    # Check if user exists
-    cursor.execute("SELECT user_id FROM user_profiles WHERE user_id = ?", (user_id,))
-    exists = cursor.fetchone()
+        conn.commit()
+    finally:
+        conn.close()
+    return True
+
+def upsert_profiles(profiles: List[Dict[str, Any]]) -> Dict[str, list]:
+    """
+    Bulk variant of upsert_profile for importing users in batches
+    Each dict must carry a 'user_id' key; rows without one are skipped
+    Everything is written in one transaction. A row that conflicts with
+    another user (e.g. an email that is already taken) is skipped and
+    reported instead of failing the batch
+    Returns {"written": [user_id, ...], "skipped": [{"user_id", "reason"}, ...]}
+    """
+    written, skipped = [], []
+    now = datetime.utcnow().isoformat()
     
-    if exists:
-        # Update existing profile
-        cursor.execute("""
-            UPDATE user_profiles
-            SET email = ?,
-                display_name = ?,
-                citizenship = ?,
-                citizenship_code = ?,
-                date_of_birth = ?,
-                passport_number = ?,
-                existing_visas = ?,
-                updated_at = ?
-            WHERE user_id = ?
-        """, (
-            profile_data.get('email'),
-            profile_data.get('display_name'),
-            profile_data.get('citizenship'),
-            profile_data.get('citizenship_code'),
-            profile_data.get('date_of_birth'),
-            profile_data.get('passport_number'),
-            profile_data.get('existing_visas'),
-            now,
-            user_id
-        ))
-    else:
-        # Insert new profile
-        cursor.execute("""
-            INSERT INTO user_profiles 
-            (user_id, email, display_name, citizenship, citizenship_code, 
-             date_of_birth, passport_number, existing_visas, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            user_id,
-            profile_data.get('email'),
-            profile_data.get('display_name'),
-            profile_data.get('citizenship'),
-            profile_data.get('citizenship_code'),
-            profile_data.get('date_of_birth'),
-            profile_data.get('passport_number'),
-            profile_data.get('existing_visas'),
-            now,
-            now
-        ))
+    conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
+    try:
+        cursor = conn.cursor()
+        for profile in profiles:
+            user_id = profile.get('user_id')
+            if not user_id:
+                skipped.append({"user_id": None, "reason": "missing user_id"})
+                continue
+            # A failed statement is rolled back on its own, the transaction carries on
+            try:
+                cursor.execute(UPSERT_PROFILE_SQL, _upsert_params(user_id, profile, now))
+                written.append(user_id)
+            except sqlite3.IntegrityError as e:
+                print(f"⚠️ Skipped profile {user_id}: {e}")
+                skipped.append({"user_id": user_id, "reason": str(e)})
+        conn.commit()
+    finally:
+        conn.close()
     
-    conn.commit()
-    conn.close()
-    return True
+    return {"written": written, "skipped": skipped}
+
+def save_user_profile(user_id: str, profile_data: Dict[str, Any]) -> bool:
+    """
+    Save or update a user's profile
+    Fields that are not passed (or are None) keep their stored value
+    Returns True if successful
+    """
+    return upsert_profile(user_id, profile_data)
 
 def update_user_field(user_id: str, field_name: str, value: Any) -> bool:
     """
@@ -161,13 +163,12 @@ def update_user_field(user_id: str, field_name: str, value: Any) -> bool:
     if not user_id:
         return False
     
-    allowed_fields = ['email', 'display_name', 'citizenship', 'citizenship_code', 
-                      'date_of_birth', 'passport_number', 'existing_visas']
-    
-    if field_name not in allowed_fields:
+    if field_name not in PROFILE_FIELDS:
         return False
+    if field_name == 'email':
+        value = normalize_email(value)
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
     cursor = conn.cursor()
     
     now = datetime.utcnow().isoformat()
@@ -187,7 +188,7 @@ def save_conversation(user_id: str, conversation_data: Dict[str, Any]) -> bool:
     if not user_id:
         return False
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
     cursor = conn.cursor()
     
     now = datetime.utcnow().isoformat()
@@ -211,6 +212,43 @@ def save_conversation(user_id: str, conversation_data: Dict[str, Any]) -> bool:
     conn.close()
     return True
 
+def save_conversations(user_id: str, conversations: List[Dict[str, Any]]) -> bool:
+    """
+    Save several interactions to history in a single transaction
+    Used by the multi-destination compare endpoint
+    """
+    if not user_id or not conversations:
+        return False
+    
+    conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
+    try:
+        cursor = conn.cursor()
+    
+        now = datetime.utcnow().isoformat()
+    
+        cursor.executemany("""
+            INSERT INTO conversation_history
+            (user_id, request_type, origin, destination, purpose, status, ai_response, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, [
+            (
+                user_id,
+                conversation.get('request_type'),
+                conversation.get('origin'),
+                conversation.get('destination'),
+                conversation.get('purpose'),
+                conversation.get('status'),
+                conversation.get('ai_response'),
+                now
+            )
+            for conversation in conversations
+        ])
+    
+        conn.commit()
+    finally:
+        conn.close()
+    return True
+
 def get_user_conversation_history(user_id: str, limit: int = 10) -> list:
     """
     Get recent conversation history for a user
@@ -218,7 +256,7 @@ def get_user_conversation_history(user_id: str, limit: int = 10) -> list:
     if not user_id:
         return []
     
-    conn = sqlite3.connect(DB_PATH)
+    conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
     cursor = conn.cursor()
     
     cursor.execute("""
@@ -244,5 +282,106 @@ def get_user_conversation_history(user_id: str, limit: int = 10) -> list:
         for row in results
     ]
 
+def get_cached_analysis(user_id: str, origin: str, destination: str) -> Optional[Dict[str, Any]]:
+    """
+    Get the last AI analysis stored for this user and corridor
+    Returns None if there is nothing cached, or it is older than ANALYSIS_CACHE_TTL_MINUTES
+    """
+    if not user_id:
+        return None
+    
+    conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
+    cursor = conn.cursor()
+    
+    cutoff = (datetime.utcnow() - timedelta(minutes=ANALYSIS_CACHE_TTL_MINUTES)).isoformat()
+    cursor.execute("""
+        SELECT analysis, missing_fields, profile_snapshot, updated_at
+        FROM analysis_cache
+        WHERE user_id = ? AND origin = ? AND destination = ? AND updated_at >= ?
+    """, (user_id, origin, destination, cutoff))
+    
+    result = cursor.fetchone()
+    conn.close()
+    
+    if not result:
+        return None
+    
+    return {
+        "analysis": json.loads(result[0]),
+        "missing_fields": json.loads(result[1]),
+        "profile": json.loads(result[2]),
+        "updated_at": result[3]
+    }
+
+def save_cached_analysis(user_id: str, origin: str, destination: str,
+                         analysis: Dict[str, Any], profile_snapshot: Dict[str, Any]) -> bool:
+    """
+    Store the AI analysis and its missing-field set for this user and corridor
+    Replaces whatever was cached before
+    """
+    if not user_id:
+        return False
+    
+    conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
+    try:
+        cursor = conn.cursor()
+    
+        now = datetime.utcnow().isoformat()
+    
+        cursor.execute("""
+            INSERT INTO analysis_cache
+            (user_id, origin, destination, analysis, missing_fields, profile_snapshot, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, origin, destination) DO UPDATE SET
+                analysis = excluded.analysis,
+                missing_fields = excluded.missing_fields,
+                profile_snapshot = excluded.profile_snapshot,
+                updated_at = excluded.updated_at
+        """, (
+            user_id,
+            origin,
+            destination,
+            json.dumps(analysis),
+            json.dumps(list(analysis.get("awaiting_feedback", {}).keys())),
+            json.dumps(profile_snapshot),
+            now
+        ))
+    
+        conn.commit()
+    finally:
+        conn.close()
+    return True
+
+def get_corridor_counts(limit: int = 20) -> list:
+    """
+    Most requested corridors, counting both live history and the
+    counters kept for rows that were archived (see scripts/archive_history.py)
+    Useful for analytics and for pre-warming caches
+    """
+    conn = sqlite3.connect(DB_PATH, factory=ProfiledConnection)
+    cursor = conn.cursor()
+    
+    cursor.execute("""
+        SELECT origin, destination, SUM(requests) AS total
+        FROM (
+            SELECT origin, destination, requests FROM corridor_stats
+            UNION ALL
+            SELECT COALESCE(origin, ''), COALESCE(destination, ''), COUNT(*)
+            FROM conversation_history
+            GROUP BY origin, destination
+        )
+        GROUP BY origin, destination
+        ORDER BY total DESC
+        LIMIT ?
+    """, (limit,))
+    
+    results = cursor.fetchall()
+    conn.close()
+    
+    return [
+        {"origin": row[0], "destination": row[1], "requests": row[2]}
+        for row in results
+    ]
+
 # Initialize the tables when this module is imported
 init_user_profiles_table()
@@ -1,14 +1,21 @@
 from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
 from core.engine import process_request as engine_process
 from core.user_profile import (
-    get_user_profile, 
     save_user_profile, 
-    update_user_field,
-    save_conversation
+    upsert_profile,
+    save_conversation,
+    save_conversations
 )
+from core.database import query_visa_rules
+from core.identity import resolve_identity, resolve_profile
+from core.countries import to_iso2
+from core.mistral_service import MAX_CONCURRENT_AI_CALLS
+from core import profiling
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 from typing import List, Optional, Any
+import asyncio
 import json
 
 app = FastAPI()
@@ -22,6 +29,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Opt-in profiling (TARA_PROFILING=1): send "X-Tara-Profile: 1" or set
+# TARA_PROFILE_SLOW_MS to capture slow requests, then see /debug/profiles.
+# Only installed when enabled, so requests skip the middleware wrapper otherwise
+if profiling.PROFILING_ENABLED:
+    app.middleware("http")(profiling.profile_request)
+
 # --- THE DATA MODEL ---
 class UserProfile(BaseModel):
     user_id: Optional[str] = None  # CRITICAL: Unique identifier for the user
@@ -36,6 +49,96 @@ class MigrationRequest(BaseModel):
     profile: UserProfile # The User Data from Login
     context: Optional[dict] = {} # Wizard answers
 
+# Limits for /tourism/compare
+MAX_COMPARE_DESTINATIONS = 10  # Destinations accepted in one request
+
+class CompareRequest(BaseModel):
+    request_type: str = "compare"
+    countries: List[str]  # The Destinations
+    type: str             # The Purpose (Visa, Residency, etc.)
+    profile: UserProfile  # The User Data from Login
+    context: Optional[dict] = {} # Wizard answers
+
+# Lower is easier. Anything not listed (including "unknown") sits just before "no admission".
+VISA_RULE_RANK = {
+    "visa free": 0,
+    "eta": 1,
+    "visa on arrival": 2,
+    "e-visa": 3,
+    "visa required": 4,
+    "no admission": 6
+}
+
+def _visa_rule_rank(rule: Optional[str]) -> int:
+    """Rank a mobility_logic rule; numeric rules are visa-free stays in days (-1 = own country)"""
+    if not rule:
+        return 5
+    rule = rule.lower()
+    if rule.lstrip("-").isdigit():
+        return 0
+    return VISA_RULE_RANK.get(rule, 5)
+
+def _resolve_citizenship(profile: UserProfile, user_id: Optional[str], stored_profile: Optional[dict]):
+    """
+    Work out the user's citizenship (stored profile first, then the request)
+    and persist a newly provided one. Returns (nationality, nationality_code)
+    """
+    user_nationality = None
+    user_nationality_code = None
+    
+    # Priority 1: Check database for stored citizenship
+    # (codes saved before names were mapped properly, e.g. "UN", are re-asked)
+    if stored_profile and to_iso2(stored_profile.get('citizenship_code')):
+        user_nationality = stored_profile['citizenship']
+        user_nationality_code = stored_profile['citizenship_code']
+        print(f"📋 Using stored citizenship: {user_nationality} ({user_nationality_code})")
+    
+    # Priority 2: Check if provided in current request
+    elif profile.nationalities and len(profile.nationalities) > 0:
+        first_nat = profile.nationalities[0]
+        if isinstance(first_nat, dict):
+            user_nationality = first_nat.get('country', 'Unknown')
+            user_nationality_code = to_iso2(first_nat.get('code') or user_nationality)
+        else:
+            user_nationality = str(first_nat)
+            user_nationality_code = to_iso2(user_nationality)
+        
+        print(f"📝 New citizenship provided: {user_nationality} ({user_nationality_code})")
+        
+        # Save this citizenship to the database for future use
+        # (single upsert: creates the profile or merges into the existing one)
+        if user_id and user_nationality_code:
+            fields = {
+                'citizenship': user_nationality,
+                'citizenship_code': user_nationality_code
+            }
+            if stored_profile:
+                # Existing profile: only the citizenship is new information
+                upsert_profile(user_id, fields)
+                print(f"💾 Updated citizenship in database")
+            else:
+                # Only store what the client actually sent, not the model's "User" default
+                if 'displayName' in profile.model_fields_set:
+                    fields['display_name'] = profile.displayName
+                upsert_profile(user_id, {'email': profile.email, **fields})
+                print(f"💾 Created new user profile in database")
+
+    return user_nationality, user_nationality_code
+
+def _citizenship_prompt(stored_profile: Optional[dict]) -> dict:
+    """Response asking the user for their citizenship"""
+    print("⚠️ MISSING CITIZENSHIP - Requesting from user")
+    return {
+        "status": "INCOMPLETE",
+        "message": "Please provide your citizenship/nationality to proceed",
+        "awaiting_feedback": {
+            "citizenship": "We need to know your country of citizenship to determine visa requirements. This will be saved to your profile and you won't be asked again."
+        },
+        "needs_more_info": True,
+        "missing_field": "citizenship",
+        "stored_profile_exists": stored_profile is not None
+    }
+
 @app.post("/tourism/check")
 async def handle_migration_request(data: MigrationRequest):
     """
@@ -148,7 +251,7 @@ async def handle_migration_request(data: MigrationRequest):
                 steps.insert(2, {"id": f"{step_id}a", "text": "Obtain work permit/employment authorization", "isCompleted": False})
             elif "student" in purpose.lower():
                 steps.insert(2, {"id": f"{step_id}a", "text": "Obtain student visa approval from institution", "isCompleted": False})
-else:
+        else:
             # Unknown status - generic steps
             steps = [
                 {"id": str(step_id), "title": "Research Requirements", "description": f"Research specific visa requirements for {destination}", "isCompleted": False},
@@ -162,73 +265,28 @@ else:
     print(f"👤 USER: {data.profile.displayName} from {data.profile.nationalities}")
     print(f"🎯 GOAL: {data.type} in {data.country}")
 
-    user_id = data.profile.user_id or data.profile.email  # Use email as fallback ID
-    
+    # Same ISO2 keys as /tourism/compare, so history and the analysis cache line up
+    destination_code = to_iso2(data.country)
+    if not destination_code:
+        return {"status": "ERROR", "message": f"Unrecognized destination: {data.country}"}
+
     # === STEP 1: Check if user profile exists in database ===
-    stored_profile = None
+    # (one key per person, whether they sent their id, their email or both)
+    user_id, stored_profile = resolve_profile(data.profile.user_id, data.profile.email)
     if user_id:
-        stored_profile = get_user_profile(user_id)
         if stored_profile:
             print(f"✅ Found existing profile for user: {user_id}")
         else:
             print(f"📝 New user - will create profile: {user_id}")
 
     # === STEP 2: Determine user's citizenship ===
-    user_nationality = None
-    user_nationality_code = None
-    
-    # Priority 1: Check database for stored citizenship
-    if stored_profile and stored_profile.get('citizenship_code'):
-        user_nationality = stored_profile['citizenship']
-        user_nationality_code = stored_profile['citizenship_code']
-        print(f"📋 Using stored citizenship: {user_nationality} ({user_nationality_code})")
-    
-    # Priority 2: Check if provided in current request
-    elif data.profile.nationalities and len(data.profile.nationalities) > 0:
-        first_nat = data.profile.nationalities[0]
-        if isinstance(first_nat, dict):
-            user_nationality = first_nat.get('country', 'Unknown')
-            user_nationality_code = first_nat.get('code', user_nationality[:2].upper())
-        else:
-            user_nationality = str(first_nat)
-            user_nationality_code = user_nationality[:2].upper()
-        
-        print(f"📝 New citizenship provided: {user_nationality} ({user_nationality_code})")
-        
-        # Save this citizenship to the database for future use
-        if user_id:
-            if stored_profile:
-                # Update existing profile
-                update_user_field(user_id, 'citizenship', user_nationality)
-                update_user_field(user_id, 'citizenship_code', user_nationality_code)
-                print(f"💾 Updated citizenship in database")
-            else:
-                # Create new profile
-                save_user_profile(user_id, {
-                    'email': data.profile.email,
-                    'display_name': data.profile.displayName,
-                    'citizenship': user_nationality,
-                    'citizenship_code': user_nationality_code
-                })
-                print(f"💾 Created new user profile in database")
+    user_nationality, user_nationality_code = _resolve_citizenship(data.profile, user_id, stored_profile)
 
     # === STEP 3: If still no citizenship, ask for it ===
-    if not user_nationality_code or user_nationality_code == "UN":
-        print("⚠️ MISSING CITIZENSHIP - Requesting from user")
-        return {
-            "status": "INCOMPLETE",
-            "message": "Please provide your citizenship/nationality to proceed",
-            "awaiting_feedback": {
-                "citizenship": "We need to know your country of citizenship to determine visa requirements. This will be saved to your profile and you won't be asked again."
-            },
-            "needs_more_info": True,
-            "missing_field": "citizenship",
-            "stored_profile_exists": stored_profile is not None
-        }
+    if not user_nationality_code:
+        return _citizenship_prompt(stored_profile)
 
     # === STEP 4: Process the request with complete data ===
-    destination_code = data.country[:2].upper()
-
     # Build comprehensive user profile for the engine
     user_profile = {
         "name": data.profile.displayName,
@@ -249,7 +307,8 @@ else:
         engine_result = engine_process(
             origin=user_nationality_code,
             dest=destination_code,
-            user_profile=user_profile
+            user_profile=user_profile,
+            user_id=user_id
         )
         
         print(f"✅ Engine returned: {engine_result.get('status')}")
@@ -333,6 +392,128 @@ else:
             "error_details": str(e)
         }
 
+@app.post("/tourism/compare")
+async def compare_destinations(data: CompareRequest):
+    """
+    Check several destinations for one user in a single request
+    One profile fetch, one visa rule query and one history write; the AI calls
+    run concurrently (capped by MAX_CONCURRENT_AI_CALLS) and results come back ranked
+    """
+    print(f"📥 RECEIVED COMPARE REQUEST: {data.type} in {data.countries}")
+
+    if not data.countries:
+        return {"status": "ERROR", "message": "Please provide at least one destination to compare"}
+    if len(data.countries) > MAX_COMPARE_DESTINATIONS:
+        return {
+            "status": "ERROR",
+            "message": f"You can compare up to {MAX_COMPARE_DESTINATIONS} destinations at once"
+        }
+
+    # Key everything on ISO2 codes (the frontend sends names). Same code twice
+    # would only duplicate the AI call
+    destinations = {}
+    unrecognized = []
+    for country in data.countries:
+        code = to_iso2(country)
+        if code:
+            destinations.setdefault(code, country)
+        else:
+            unrecognized.append(country)
+    if unrecognized:
+        return {
+            "status": "ERROR",
+            "message": f"Unrecognized destination(s): {', '.join(unrecognized)}",
+            "unrecognized_destinations": unrecognized
+        }
+
+    user_id, stored_profile = resolve_profile(data.profile.user_id, data.profile.email)  # One key per person
+
+    user_nationality, user_nationality_code = _resolve_citizenship(data.profile, user_id, stored_profile)
+    if not user_nationality_code:
+        return _citizenship_prompt(stored_profile)
+
+
+    user_profile = {
+        "name": data.profile.displayName,
+        "email": data.profile.email,
+        "citizenship": user_nationality,
+        "nationality_code": user_nationality_code,
+        "purpose": data.type,
+        **(stored_profile or {}),
+        **data.context
+    }
+
+    rules = query_visa_rules(user_nationality_code, list(destinations))
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_AI_CALLS)
+
+    async def _check(destination_code: str):
+        async with semaphore:
+            try:
+                return await asyncio.to_thread(
+                    profiling.traced(engine_process),
+                    origin=user_nationality_code,
+                    dest=destination_code,
+                    user_profile=user_profile,
+                    user_id=user_id,
+                    db_status=rules.get(destination_code)
+                )
+            except Exception as e:
+                print(f"❌ ERROR in engine processing for {destination_code}: {e}")
+                return {"status": "ERROR", "summary": rules.get(destination_code), "error_details": str(e)}
+
+    engine_results = await asyncio.gather(*(_check(code) for code in destinations))
+
+    results = []
+    for (destination_code, country), engine_result in zip(destinations.items(), engine_results):
+        expert_analysis = engine_result.get("expert_analysis", {})
+        awaiting_feedback = expert_analysis.get("awaiting_feedback", {})
+        results.append({
+            "destination": country,
+            "destination_code": destination_code,
+            "status": engine_result.get("status"),
+            "visa_requirement": engine_result.get("summary", "unknown"),
+            "forms": expert_analysis.get("forms", []),
+            "health": expert_analysis.get("health", []),
+            "safety": expert_analysis.get("safety", []),
+            "awaiting_feedback": awaiting_feedback,
+            "needs_more_info": len(awaiting_feedback) > 0,
+            "data_source": engine_result.get("data_source", "Hybrid (DB + AI)"),
+            "_ai_response": expert_analysis
+        })
+
+    # Easiest entry first, then complete answers, then fewest open questions
+    results.sort(key=lambda r: (
+        _visa_rule_rank(r["visa_requirement"]),
+        r["status"] != "SUCCESS",
+        len(r["awaiting_feedback"])
+    ))
+
+    if user_id:
+        save_conversations(user_id, [
+            {
+                'request_type': data.request_type,
+                'origin': user_nationality_code,
+                'destination': r["destination_code"],
+                'purpose': data.type,
+                'status': r["status"],
+                'ai_response': json.dumps(r["_ai_response"])
+            }
+            for r in results
+        ])
+
+    for rank, r in enumerate(results, start=1):
+        r.pop("_ai_response")
+        r["rank"] = rank
+
+    return {
+        "status": "SUCCESS",
+        "origin": user_nationality,
+        "purpose": data.type,
+        "comparison": results,
+        "user_has_stored_profile": stored_profile is not None,
+        "message": f"Compared {len(results)} destinations."
+    }
+
 # Health check endpoint
 @app.get("/health")
 async def health_check():
@@ -347,7 +528,7 @@ async def health_check():
 @app.get("/profile/{user_id}")
 async def get_profile(user_id: str):
     """Retrieve a user's stored profile"""
-    profile = get_user_profile(user_id)
+    _, profile = resolve_profile(user_id, register=False)
     if profile:
         return {
             "status": "success",
@@ -382,7 +563,8 @@ async def update_profile(update: ProfileUpdate):
     # Remove None values
     profile_data = {k: v for k, v in profile_data.items() if v is not None}
     
-    success = save_user_profile(update.user_id, profile_data)
+    user_id, _ = resolve_profile(update.user_id)
+    success = save_user_profile(user_id, profile_data)
     
     if success:
         return {
@@ -415,13 +597,33 @@ async def debug_request(data: MigrationRequest):
         "interpretation": {
             "destination": data.country,
             "purpose": data.type,
-            "user_id": data.profile.user_id or data.profile.email,
+            "user_id": resolve_identity(data.profile.user_id, data.profile.email, register=False),
             "user_name": data.profile.displayName,
             "citizenship_data": data.profile.nationalities,
             "has_citizenship": len(data.profile.nationalities) > 0 if data.profile.nationalities else False
         }
     }
 
+# Captured request profiles
+@app.get("/debug/profiles")
+async def list_profiles():
+    """List captured profiles, newest first"""
+    if not profiling.PROFILING_ENABLED:
+        return {"status": "disabled", "message": "Set TARA_PROFILING=1 to enable request profiling"}
+    return {"status": "success", "profiles": profiling.list_profiles()}
+
+@app.get("/debug/profiles/{profile_id}")
+async def download_profile(profile_id: str, format: str = "json"):
+    """Download a profile as JSON, or with ?format=folded as flamegraph input"""
+    if not profiling.PROFILING_ENABLED:
+        return {"status": "disabled", "message": "Set TARA_PROFILING=1 to enable request profiling"}
+    profile = profiling.get_profile(profile_id)
+    if not profile:
+        return {"status": "not_found", "message": "No profile found with this id"}
+    if format == "folded":
+        return PlainTextResponse(profiling.folded_stacks(profile))
+    return {"status": "success", "profile": profile}
+
 if __name__ == "__main__":
     import uvicorn
     print("🚀 Starting TARA Backend with full integration...")
@@ -0,0 +1,136 @@
+"""
+Retention job for conversation_history.
+Moves rows older than the retention window into gzipped JSONL archive files,
+folds them into the per-corridor counters in corridor_stats, deletes them in
+small batches and hands the freed pages back to the filesystem.
+
+Run it on a schedule, e.g. nightly from cron:
+    0 3 * * * cd /path/to/Backend && python scripts/archive_history.py
+"""
+import sqlite3
+import gzip
+import json
+import os
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core.migrations import run_migrations
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DB_PATH = os.getenv("TARA_DB_PATH", os.path.join(BASE_DIR, 'tara_migration.db'))
+ARCHIVE_DIR = os.getenv("TARA_ARCHIVE_DIR", os.path.join(BASE_DIR, 'archive'))
+RETENTION_DAYS = int(os.getenv("TARA_HISTORY_RETENTION_DAYS", "90"))
+CHUNK_SIZE = int(os.getenv("TARA_ARCHIVE_CHUNK_SIZE", "500"))
+# Pause between batches so request writers get the lock in between
+BATCH_PAUSE_SECONDS = float(os.getenv("TARA_ARCHIVE_PAUSE_SECONDS", "0.05"))
+
+COLUMNS = ["id", "user_id", "request_type", "origin", "destination",
+           "purpose", "status", "ai_response", "created_at"]
+
+
+def _ensure_incremental_vacuum(conn):
+    """
+    Switch the file to auto_vacuum=INCREMENTAL. Only takes effect after a
+    full VACUUM, so that one-off (blocking) VACUUM happens the first time
+    """
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        print("🧹 Enabling incremental vacuum (one-off full VACUUM)...")
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        conn.execute("VACUUM")
+
+
+def _write_archive(rows: list) -> str:
+    """
+    Write one chunk to its own archive file. The name comes from the id
+    range, so re-running after a crash overwrites instead of duplicating
+    """
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    ids = [row["id"] for row in rows]
+    path = os.path.join(ARCHIVE_DIR, f"conversation_history-{min(ids):012d}-{max(ids):012d}.jsonl.gz")
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return path
+
+
+def _fold_into_counters(cursor, rows: list):
+    """Add the chunk to the per-corridor counters in corridor_stats"""
+    counts = Counter()
+    first_seen, last_seen = {}, {}
+    for row in rows:
+        key = tuple(row[column] or '' for column in ("origin", "destination", "purpose", "status"))
+        counts[key] += 1
+        first_seen[key] = min(first_seen.get(key, row["created_at"]), row["created_at"])
+        last_seen[key] = max(last_seen.get(key, row["created_at"]), row["created_at"])
+
+    cursor.executemany("""
+        INSERT INTO corridor_stats (origin, destination, purpose, status, requests, first_seen, last_seen)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(origin, destination, purpose, status) DO UPDATE SET
+            requests = requests + excluded.requests,
+            first_seen = MIN(first_seen, excluded.first_seen),
+            last_seen = MAX(last_seen, excluded.last_seen)
+    """, [(*key, count, first_seen[key], last_seen[key]) for key, count in counts.items()])
+
+
+def archive_history(retention_days: int = RETENTION_DAYS, db_path: str = DB_PATH) -> int:
+    """
+    Archive and delete history older than retention_days
+    Returns the number of rows archived
+    """
+    run_migrations(db_path)
+    cutoff = (datetime.utcnow() - timedelta(days=retention_days)).isoformat()
+
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    conn.execute("PRAGMA busy_timeout = 5000")
+    _ensure_incremental_vacuum(conn)
+    cursor = conn.cursor()
+
+    print(f"📦 Archiving conversation_history older than {cutoff} to {ARCHIVE_DIR}")
+    archived = 0
+    while True:
+        cursor.execute(f"""
+            SELECT {', '.join(COLUMNS)} FROM conversation_history
+            WHERE created_at < ?
+            ORDER BY created_at, id
+            LIMIT ?
+        """, (cutoff, CHUNK_SIZE))
+        rows = [dict(zip(COLUMNS, row)) for row in cursor.fetchall()]
+        if not rows:
+            break
+
+        # The file is on disk before the rows go, so a crash loses nothing
+        path = _write_archive(rows)
+
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            _fold_into_counters(cursor, rows)
+            cursor.executemany("DELETE FROM conversation_history WHERE id = ?", [(row["id"],) for row in rows])
+            cursor.execute("COMMIT")
+        except Exception:
+            cursor.execute("ROLLBACK")
+            conn.close()
+            raise
+
+        archived += len(rows)
+        print(f"   {len(rows)} rows -> {os.path.basename(path)}")
+        time.sleep(BATCH_PAUSE_SECONDS)
+
+    # Give the freed pages back and keep the WAL file from lingering at full size
+    # (the pragma frees one page per step and execute() only steps once,
+    # executescript runs it to completion)
+    conn.executescript("PRAGMA incremental_vacuum;")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    print(f"✅ Archived {archived} rows")
+    return archived
+
+if __name__ == "__main__":
+    archive_history()
@@ -1,19 +1,36 @@
 import sqlite3
 import pandas as pd
 import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core.migrations import run_migrations
 
 def sync_data():
     BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    DB_PATH = os.path.join(BASE_DIR, 'tara_migration.db')
+    DB_PATH = os.getenv("TARA_DB_PATH", os.path.join(BASE_DIR, 'tara_migration.db'))
     URL = "https://raw.githubusercontent.com/ilyankou/passport-index-dataset/master/passport-index-tidy-iso2.csv"
-    
+
     print("🌍 Downloading latest visa rules...")
-    df = pd.read_csv(URL).rename(columns={'Passport': 'origin', 'Destination': 'dest', 'Requirement': 'rule'})
-    
+    # keep_default_na=False: otherwise Namibia's "NA" code is read as a missing value
+    df = pd.read_csv(URL, keep_default_na=False).rename(columns={'Passport': 'origin', 'Destination': 'dest', 'Requirement': 'rule'})
+
+    # Make sure mobility_logic exists with its keys, then swap the rows in
+    # through a staging table so the table keeps its schema and readers never
+    # see it empty (one short write transaction, WAL keeps readers going)
+    run_migrations(DB_PATH)
     conn = sqlite3.connect(DB_PATH)
-    df.to_sql('mobility_logic', conn, if_exists='replace', index=False)
+    df[['origin', 'dest', 'rule']].to_sql('mobility_logic_staging', conn, if_exists='replace', index=False)
+    with conn:
+        conn.execute("DELETE FROM mobility_logic")
+        conn.execute("""
+            INSERT OR REPLACE INTO mobility_logic (origin, dest, rule)
+            SELECT origin, dest, rule FROM mobility_logic_staging
+        """)
+        conn.execute("DROP TABLE mobility_logic_staging")
+    conn.execute("ANALYZE mobility_logic")
     conn.close()
     print(f"✅ Saved {len(df)} rules to {DB_PATH}")
 
 if __name__ == "__main__":
-    sync_data()
\ No newline at end of file
+    sync_data()
@@ -0,0 +1,123 @@
+"""
+Identity resolution against a throwaway database
+Run from Backend/: python -m pytest -q tests/test_identity.py
+"""
+import os
+import sys
+import sqlite3
+import tempfile
+
+import pytest
+
+# Importing core.user_profile migrates DB_PATH, so point it away from the
+# tracked tara_migration.db before anything is imported
+os.environ["TARA_DB_PATH"] = os.path.join(tempfile.mkdtemp(), "tara_import.db")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from core import identity, user_profile, mistral_service
+from core.migrations import run_migrations
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "tara_test.db")
+    run_migrations(path)
+    monkeypatch.setenv("TARA_DB_PATH", path)
+    for module in (identity, user_profile):
+        monkeypatch.setattr(module, "DB_PATH", path)
+    monkeypatch.setattr(mistral_service, "ADVICE_MODE", "local")
+    monkeypatch.setattr(identity, "_alias_cache", {})
+    return path
+
+
+def _seed_duplicate(db_path):
+    """An id-keyed profile without email plus an email-keyed one that knows the citizenship"""
+    conn = sqlite3.connect(db_path)
+    conn.executemany("""
+        INSERT INTO user_profiles (user_id, email, citizenship, citizenship_code, created_at, updated_at)
+        VALUES (?, ?, ?, ?, '2024-01-01T00:00:00', '2024-01-01T00:00:00')
+    """, [("U1", None, None, None), ("bob@x.com", "bob@x.com", "France", "FR")])
+    conn.executemany("INSERT INTO identity_aliases (alias, user_id) VALUES (?, ?)",
+                     [("U1", "U1"), ("bob@x.com", "bob@x.com")])
+    conn.execute("""
+        INSERT INTO conversation_history (user_id, request_type, created_at)
+        VALUES ('bob@x.com', 'tourism_check', '2024-01-01T00:00:00')
+    """)
+    conn.commit()
+    conn.close()
+
+
+def test_id_and_email_on_different_profiles_are_merged(db_path):
+    _seed_duplicate(db_path)
+    # Both keys cached with their old, conflicting mappings
+    identity._alias_cache.update({"U1": "U1", "bob@x.com": "bob@x.com"})
+
+    assert identity.resolve_identity("U1", "Bob@X.com ") == "U1"
+
+    profile = user_profile.get_user_profile("U1")
+    assert profile["citizenship_code"] == "FR"
+    assert profile["email"] == "bob@x.com"
+    assert user_profile.get_user_profile("bob@x.com") is None
+    assert identity._alias_cache["bob@x.com"] == "U1"
+
+    conn = sqlite3.connect(db_path)
+    assert dict(conn.execute("SELECT alias, user_id FROM identity_aliases")) == {"U1": "U1", "bob@x.com": "U1"}
+    assert conn.execute("SELECT user_id FROM conversation_history").fetchall() == [("U1",)]
+    conn.close()
+
+    # Either key alone now lands on the merged profile
+    assert identity.resolve_identity(email="bob@x.com") == "U1"
+    assert identity.resolve_identity("U1") == "U1"
+
+
+def test_alias_cached_by_another_worker_is_refreshed_after_a_merge(db_path):
+    _seed_duplicate(db_path)
+    identity.resolve_identity("U1", "bob@x.com")
+    # Another worker cached the email before the merge removed its profile
+    identity._alias_cache["bob@x.com"] = "bob@x.com"
+
+    user_id, profile = identity.resolve_profile(email="bob@x.com")
+
+    assert user_id == "U1"
+    assert profile["citizenship_code"] == "FR"
+    assert identity._alias_cache["bob@x.com"] == "U1"
+
+
+def test_lookup_only_does_not_merge(db_path):
+    _seed_duplicate(db_path)
+
+    identity.resolve_identity("U1", "bob@x.com", register=False)
+
+    assert user_profile.get_user_profile("bob@x.com") is not None
+    assert user_profile.get_user_profile("U1")["citizenship_code"] is None
+
+
+def test_email_of_a_profile_written_without_alias_resolves_to_it(db_path):
+    # Bulk imports don't go through resolve_identity, so there is no alias row
+    user_profile.upsert_profiles([{"user_id": "B1", "email": "b@x.com"}])
+
+    assert identity.resolve_identity(email="B@x.com") == "B1"
+    assert identity.resolve_identity("B1", "b@x.com") == "B1"
+    # Writing the resolved key again doesn't collide with UNIQUE(email)
+    assert user_profile.upsert_profile("B1", {"email": "b@x.com", "citizenship_code": "FR"})
+
+
+def test_tourism_check_uses_merged_profile(db_path):
+    from fastapi.testclient import TestClient
+    import main
+
+    _seed_duplicate(db_path)
+    client = TestClient(main.app)
+    payload = {
+        "request_type": "tourism_check",
+        "country": "Japan",
+        "type": "Tourism",
+        # No nationality sent: it has to come from the merged profile
+        "profile": {"user_id": "U1", "email": "bob@x.com", "displayName": "Bob", "nationalities": []},
+        "context": {}
+    }
+
+    response = client.post("/tourism/check", json=payload)
+
+    assert response.status_code == 200
+    assert response.json()["status"] != "INCOMPLETE"